@@ -1,32 +1,132 @@
+from __future__ import annotations
+
+import asyncio
+import csv
 import os
 import re
-import pandas as pd
+import sqlite3
+import threading
+import time
+from io import StringIO
+from typing import TYPE_CHECKING
+
 import streamlit as st
 from dotenv import load_dotenv
 
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.agent_toolkits import SQLDatabaseToolkit
-from langchain_community.utilities import SQLDatabase
-from langchain.tools import Tool
-from langgraph.prebuilt import create_react_agent
 from langchain_core.tools import tool
-from sqlalchemy import inspect
+
+# Heavy modules (pandas, numpy, langchain_*, langgraph, sqlalchemy) are imported
+# inside the functions that use them so the first paint doesn't wait on them.
+if TYPE_CHECKING:
+    import pandas as pd
+    from langchain_community.utilities import SQLDatabase
 
 
 load_dotenv()
 
+_SEP_RE = re.compile(r"^\s*\|\s*[-: ]+\|")
+# Code fences are dropped; tool names and "SQL" are replaced, all in one pass
+_SANITIZE_RE = re.compile(r"(```[\s\S]*?```)|(db_exec(?:_many)?_tool)|(\bSQL\b)", re.IGNORECASE)
+_CHART_RE = re.compile(
+    r"\b(line|bar|column|area|scatter)s?(?:\b.*?)?(?:chart|graph|plot)"
+    r"|(?:chart|graph|plot).*?\b(line|bar|column|area|scatter)s?\b"
+)
+_THOUSANDS_RE = re.compile(r"-?(\d{1,3}(,\d{3})+|\d+)(\.\d+)?")
+_WORD_RE = re.compile(r"\d+(?:\.\d+)?|[a-z][a-z0-9_']*")
+_STOPWORDS = frozenset(
+    "a an the and or of for to in on at by with from as is are was were be been do does did "
+    "what which who whom how many much me my i we our us you your there their it its this that "
+    "these those show list give tell find get display please can could would all any some "
+    "have has had each per about".split()
+)
+
+MAX_STRING_LENGTH = 300  # per-value truncation for query results sent to the model
+
+MAX_HISTORY = 20
+KEEP_HISTORY = 16
+
+CACHE_DIR = ".cache"
+CACHE_SIMILARITY_THRESHOLD = 0.95
+CACHE_TTL_SECONDS = 15 * 60  # answers describe live data, so they go stale
+CACHE_MAX_ROWS = 500
+
+COLUMNS_SQL = (
+    "SELECT table_name, column_name FROM information_schema.columns "
+    "WHERE table_schema = 'public' AND table_name = ANY(:tables) "
+    "ORDER BY table_name, ordinal_position"
+)
+FOREIGN_KEYS_SQL = (
+    "SELECT kcu.table_name, kcu.constraint_name, kcu.column_name, ref.table_name, ref.column_name "
+    "FROM information_schema.table_constraints tc "
+    "JOIN information_schema.key_column_usage kcu "
+    "ON kcu.constraint_schema = tc.constraint_schema AND kcu.constraint_name = tc.constraint_name "
+    "JOIN information_schema.referential_constraints rc "
+    "ON rc.constraint_schema = tc.constraint_schema AND rc.constraint_name = tc.constraint_name "
+    "JOIN information_schema.key_column_usage ref "
+    "ON ref.constraint_schema = rc.unique_constraint_schema AND ref.constraint_name = rc.unique_constraint_name "
+    "AND ref.ordinal_position = kcu.position_in_unique_constraint "
+    "WHERE tc.constraint_type = 'FOREIGN KEY' AND tc.table_schema = 'public' AND kcu.table_name = ANY(:tables) "
+    "ORDER BY kcu.table_name, kcu.constraint_name, kcu.ordinal_position"
+)
+
 
 @st.cache_resource(show_spinner=False)
 def get_llm():
-    api_key = os.getenv("GOOGLE_API_KEY")
-    os.environ["GOOGLE_API_KEY"] = api_key or ""
-    return ChatGoogleGenerativeAI(model="gemini-2.5-flash")
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    return ChatGoogleGenerativeAI(model="gemini-2.5-flash", google_api_key=os.getenv("GOOGLE_API_KEY"))
+
+
+SYSTEM_PROMPT = (
+    "You are a database analyst. Generate a correct Postgres query with quoted identifiers and execute it via db_exec_tool (use db_exec_many_tool to run several independent queries in one batch). "
+    "Prefer user-friendly details over raw IDs: where possible, join to include human-friendly names (e.g., branch names, service type names). "
+    "Never invent table or column names. If a query fails due to casing/missing relation, adjust quoting and retry once. "
+    "Respond for non-technical users: first provide a concise plain-English summary (one or two sentences). Then include a small Markdown table (max 10 rows) with clear column headers suitable for charting (e.g., ‘Route’, ‘Shipments’). Do NOT show SQL or mention tools."
+)
+SCHEMA_FROM_TOOLS = (
+    "\n\nUse the tools to list tables and fetch the relevant schemas first "
+    "(issue independent tool calls together in the same step)."
+)
+SCHEMA_FROM_OVERVIEW = (
+    "\n\nThe schema overview below is authoritative: take table and column names from it and do not call "
+    "sql_db_list_tables. Call sql_db_schema only when you need column types or sample rows."
+)
+
+
+def build_system_prompt(tables, columns_by_table, relationships) -> str:
+    # Static instructions first, then the schema overview, so the system message is
+    # byte-identical across turns and can serve as a cached prompt prefix once it is large
+    # enough for the provider. (For Anthropic/Bedrock models this block would also carry
+    # cache_control={"type": "ephemeral"}.)
+    if not tables:
+        return SYSTEM_PROMPT + SCHEMA_FROM_TOOLS
+    schema_lines = [f"- {t}({', '.join(columns_by_table.get(t) or [])})" for t in tables]
+    parts = [SYSTEM_PROMPT, SCHEMA_FROM_OVERVIEW, "\n\nDatabase schema (table(columns)):\n" + "\n".join(schema_lines)]
+    if relationships:
+        parts.append("\n\nForeign keys:\n" + "\n".join(f"- {rel}" for rel in relationships))
+    return "".join(parts)
+
+
+@st.cache_resource(show_spinner=False)
+def get_engine():
+    from sqlalchemy import create_engine
+
+    # Sized for concurrent Streamlit sessions, each fanning out several tool calls
+    return create_engine(
+        os.getenv("DATABASE_URL"),
+        pool_size=20,
+        max_overflow=40,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+    )
 
 
 @st.cache_resource(show_spinner=False)
 def get_db_and_tools():
-    database_url = os.getenv("DATABASE_URL")
-    db = SQLDatabase.from_uri(database_url)
+    from langchain_community.agent_toolkits import SQLDatabaseToolkit
+    from langchain_community.utilities import SQLDatabase
+
+    db = SQLDatabase(get_engine(), max_string_length=MAX_STRING_LENGTH)
     llm = get_llm()
     toolkit = SQLDatabaseToolkit(db=db, llm=llm)
     tools = toolkit.get_tools()
@@ -37,13 +137,64 @@ def get_db_and_tools():
 
 
 def build_agent(llm, list_tables_tool, get_schema_tool):
-    # One agent with all DB tools (LLM-driven)
+    from langgraph.prebuilt import ToolNode, create_react_agent
+
+    # One agent with all DB tools (LLM-driven). ToolNode runs every tool call
+    # from a single AIMessage together (asyncio.gather on the async path), so
+    # list_tables/get_schema issued in the same turn don't wait on each other.
     return create_react_agent(
         llm,
-        tools=[list_tables_tool, get_schema_tool, db_exec_tool],
+        tools=ToolNode([list_tables_tool, get_schema_tool, db_exec_tool, db_exec_many_tool]),
     )
 
 
+@st.cache_resource(show_spinner=False)
+def get_agent():
+    # Compile the LangGraph agent once per process instead of once per message
+    _db, llm, list_tables_tool, get_schema_tool, _query_tool = get_db_and_tools()
+    return build_agent(llm, list_tables_tool, get_schema_tool)
+
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    # One long-lived loop so async LLM clients stay bound to the same loop across reruns
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def iter_async(agen):
+    # Drive an async generator on the shared loop from Streamlit's script thread
+    loop = get_event_loop()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+async def stream_answer(agent, system_msg: str, user_input: str):
+    """Yield ("token", text) while the agent writes, ("reset", None) when a tool result arrives and ("final", text) at the end."""
+    from langchain_core.messages import AIMessageChunk, ToolMessage
+
+    final_text = ""
+    # The async path lets ToolNode gather the tool calls of each step concurrently
+    async for mode, chunk in agent.astream(
+        {"messages": [("system", system_msg), ("user", user_input)]},
+        stream_mode=["messages", "values"],
+    ):
+        if mode == "values":
+            final_text = chunk["messages"][-1].content
+            continue
+        message, _metadata = chunk
+        if isinstance(message, ToolMessage):
+            # Anything streamed before a tool call was intermediate reasoning
+            yield "reset", None
+        elif isinstance(message, AIMessageChunk) and isinstance(message.content, str) and message.content:
+            yield "token", message.content
+    yield "final", final_text
+
+
 @tool
 def db_exec_tool(query: str) -> str:
     """Execute the provided SQL query against the configured database and return the raw result or an error string."""
@@ -56,35 +207,196 @@ def db_exec_tool(query: str) -> str:
         return f"Error: {e}"
 
 
-def get_db_metadata(sql_db: SQLDatabase):
+@tool
+def db_exec_many_tool(queries: list[str]) -> str:
+    """Execute several independent SQL queries in one batch. Returns one labeled line per query ("Query 1: ...") with its rows, "(no rows)" or an error string. Prefer this over repeated db_exec_tool calls when a question needs multiple separate lookups."""
+    queries = [q.replace("```sql", "").replace("```", "").strip() for q in queries]
+    results = _exec_batch(queries)
+    return "\n".join(f"Query {i}: {result or '(no rows)'}" for i, result in enumerate(results, 1))
+
+
+def _exec_batch(queries: list[str]) -> list[str]:
+    engine = get_engine()
+    if engine.dialect.driver != "psycopg":
+        # Driver without pipeline mode (e.g. psycopg2): run one by one
+        db, *_rest = get_db_and_tools()
+        return [str(db.run_no_throw(q)) for q in queries]
+    raw = engine.raw_connection()
     try:
-        engine = sql_db._engine
-        insp = inspect(engine)
-        tables = sorted(list(sql_db.get_usable_table_names()))
-        columns_by_table = {}
-        relationships = []
-        for t in tables:
-            try:
-                cols = insp.get_columns(t)
-                columns_by_table[t] = [c.get("name") for c in cols]
-            except Exception:
-                columns_by_table[t] = []
+        conn = raw.driver_connection
+        try:
+            # psycopg3 pipeline: send every query before waiting on any result
+            with conn.pipeline():
+                cursors = [conn.execute(q) for q in queries]
+                results = [_format_rows(cur) for cur in cursors]
+            raw.commit()
+            return results
+        except Exception:
+            raw.rollback()
+        # Something failed: rerun each query in its own savepoint so errors
+        # attach to the query that caused them and the others still return
+        results = []
+        for q in queries:
             try:
-                fks = insp.get_foreign_keys(t)
-                for fk in fks:
-                    referred_table = fk.get("referred_table")
-                    constrained_cols = fk.get("constrained_columns") or []
-                    referred_cols = fk.get("referred_columns") or []
-                    relationships.append(
-                        f"{t}({', '.join(constrained_cols)}) -> {referred_table}({', '.join(referred_cols)})"
-                    )
-            except Exception:
-                pass
+                with conn.transaction():
+                    results.append(_format_rows(conn.execute(q)))
+            except Exception as e:
+                results.append(f"Error: {e}")
+        raw.commit()
+        return results
+    finally:
+        raw.close()
+
+
+def _format_rows(cur) -> str:
+    # Same shape and value truncation as SQLDatabase.run
+    from langchain_community.utilities.sql_database import truncate_word
+
+    rows = cur.fetchall() if cur.description else []
+    if not rows:
+        return ""
+    return str([tuple(truncate_word(v, length=MAX_STRING_LENGTH) for v in row) for row in rows])
+
+
+def trim_history():
+    # Once history passes MAX_HISTORY, keep only the last KEEP_HISTORY entries so session
+    # state stays bounded; render_payloads is cut the same way to stay index-aligned
+    if len(st.session_state.history) <= MAX_HISTORY:
+        return
+    st.session_state.history = st.session_state.history[-KEEP_HISTORY:]
+    st.session_state.render_payloads = st.session_state.render_payloads[-KEEP_HISTORY:]
+
+
+# --- Response cache helpers ---
+
+def normalize_question(text: str) -> str:
+    return " ".join(text.strip().lower().split())
+
+
+def question_terms(question: str) -> frozenset[str]:
+    # Content words and numbers of a normalized question. A semantic hit must ask about
+    # exactly the same terms, so "top 5" never answers "top 10" and "john doe" never
+    # answers "jane smith"; only wording, word order and filler words may differ.
+    terms = set()
+    for word in _WORD_RE.findall(question):
+        if word in _STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word[0].isdigit():
+            word = word[:-1]
+        terms.add(word)
+    return frozenset(terms)
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    # Persisted under .cache/ so answers survive reruns and app restarts (within the TTL)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(CACHE_DIR, "responses.sqlite3"), check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cached_answers ("
+        "question TEXT PRIMARY KEY, embedding BLOB NOT NULL, answer TEXT NOT NULL, created_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS cached_answers_created_at ON cached_answers (created_at)")
+    conn.commit()
+    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004", google_api_key=os.getenv("GOOGLE_API_KEY"))
+    return conn, embeddings, threading.Lock()
+
+
+def cache_lookup(question: str) -> tuple[str | None, list[float] | None]:
+    """Return (cached answer or None, embedding of the question) for a normalized question."""
+    import numpy as np
+
+    try:
+        conn, embeddings, lock = get_response_cache()
+        cutoff = time.time() - CACHE_TTL_SECONDS
+        with lock:
+            row = conn.execute(
+                "SELECT answer FROM cached_answers WHERE question = ? AND created_at >= ?", (question, cutoff)
+            ).fetchone()
+            if row:
+                return row[0], None
+            rows = conn.execute(
+                "SELECT question, embedding, answer FROM cached_answers WHERE created_at >= ?", (cutoff,)
+            ).fetchall()
+        vector = embeddings.embed_query(question)
+        terms = question_terms(question)
+        rows = [r for r in rows if question_terms(r[0]) == terms]
+        if not rows:
+            return None, vector
+        matrix = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float32).reshape(len(rows), -1)
+        query = np.asarray(vector, dtype=np.float32)
+        scores = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+        best = int(np.argmax(scores))
+        if scores[best] >= CACHE_SIMILARITY_THRESHOLD:
+            return rows[best][2], vector
+        return None, vector
+    except Exception:
+        return None, None
+
+
+def cache_store(question: str, vector: list[float] | None, answer: str) -> None:
+    import numpy as np
+
+    if not vector or not answer:
+        return
+    try:
+        conn, _embeddings, lock = get_response_cache()
+        now = time.time()
+        with lock:
+            conn.execute(
+                "INSERT OR REPLACE INTO cached_answers (question, embedding, answer, created_at) VALUES (?, ?, ?, ?)",
+                (question, np.asarray(vector, dtype=np.float32).tobytes(), answer, now),
+            )
+            # Drop expired answers and keep only the newest CACHE_MAX_ROWS
+            conn.execute(
+                "DELETE FROM cached_answers WHERE created_at < ? OR question NOT IN "
+                "(SELECT question FROM cached_answers ORDER BY created_at DESC LIMIT ?)",
+                (now - CACHE_TTL_SECONDS, CACHE_MAX_ROWS),
+            )
+            conn.commit()
+    except Exception:
+        pass
+
+
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def load_db_metadata(_sql_db: SQLDatabase):
+    # Leading underscore keeps Streamlit from hashing the SQLDatabase object.
+    # Errors propagate so a failed fetch is never cached; see get_db_metadata.
+    from sqlalchemy import text
+
+    tables = sorted(list(_sql_db.get_usable_table_names()))
+    columns_by_table = {t: [] for t in tables}
+    relationships = []
+    if not tables:
         return tables, columns_by_table, relationships
+    with get_engine().connect() as conn:
+        # Two bulk queries instead of two inspector round-trips per table
+        rows = conn.execute(text(COLUMNS_SQL), {"tables": tables}).fetchall()
+        for table_name, column_name in rows:
+            columns_by_table[table_name].append(column_name)
+        rows = conn.execute(text(FOREIGN_KEYS_SQL), {"tables": tables}).fetchall()
+        fks = {}
+        for table_name, constraint_name, column_name, referred_table, referred_column in rows:
+            fk = fks.setdefault((table_name, constraint_name), (referred_table, [], []))
+            fk[1].append(column_name)
+            fk[2].append(referred_column)
+        for (t, _name), (referred_table, constrained_cols, referred_cols) in fks.items():
+            relationships.append(
+                f"{t}({', '.join(constrained_cols)}) -> {referred_table}({', '.join(referred_cols)})"
+            )
+    return tables, columns_by_table, relationships
+
+
+def get_db_metadata(sql_db: SQLDatabase):
+    try:
+        return load_db_metadata(sql_db)
     except Exception:
         return [], {}, []
 
 
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
 def suggest_questions(tables, columns_by_table):
     suggestions = []
     if tables:
@@ -125,63 +437,78 @@ def render_sidebar_dynamic(sql_db: SQLDatabase):
         st.write(f"- {q}")
 
 
+def sanitize_text(text: str) -> str:
+    return _SANITIZE_RE.sub(lambda m: "" if m.group(1) else "the database", text)
+
+
 # --- Visualization helpers ---
 
-def wants_chart(user_text: str) -> str | None:
-    t = user_text.lower()
-    if "line" in t and ("chart" in t or "graph" in t or "plot" in t):
-        return "line"
-    if ("bar" in t or "column" in t) and ("chart" in t or "graph" in t or "plot" in t):
-        return "bar"
-    if "area" in t and ("chart" in t or "graph" in t or "plot" in t):
-        return "area"
-    if "scatter" in t and ("chart" in t or "graph" in t or "plot" in t):
-        return "scatter"
-    return None
-
-
-def extract_markdown_table(text: str) -> tuple[str, pd.DataFrame | None]:
-    # Split summary from the first markdown table block
+def wants_chart(lower_text: str) -> str | None:
+    # Expects already lower-cased input; one scan finds "<type> ... chart/graph/plot"
+    m = _CHART_RE.search(lower_text)
+    if not m:
+        return None
+    kind = m.group(1) or m.group(2)
+    return "bar" if kind == "column" else kind
+
+
+def extract_markdown_table(text: str) -> tuple[str, pd.DataFrame | None, str | None]:
+    import pandas as pd
+
+    # Split summary from the first markdown table block in a single walk over the lines:
+    # search for a "|" header, confirm it with a separator row, then consume body rows.
     lines = text.splitlines()
-    start, sep, end = -1, -1, -1
-    for i, line in enumerate(lines):
-        if line.strip().startswith("|") and "|" in line.strip():
-            # header candidate found
-            if i + 1 < len(lines) and re.match(r"^\s*\|\s*[-: ]+\|", lines[i + 1]):
-                start = i
-                sep = i + 1
-                # find end of table (first non table-looking line after sep)
-                j = sep + 1
-                while j < len(lines) and lines[j].strip().startswith("|"):
-                    j += 1
-                end = j
+    stripped = [line.strip() for line in lines]
+    state, start, end = "search", -1, len(lines)
+    for i, line in enumerate(stripped):
+        if state == "body":
+            if not line.startswith("|"):
+                end = i
                 break
-    if start == -1:
-        return text, None
+        elif state == "header" and _SEP_RE.match(line):
+            state = "body"
+        elif line.startswith("|"):
+            state, start = "header", i
+        else:
+            state = "search"
+    if state != "body":
+        return text, None, None
 
     summary = "\n".join(lines[:start]).strip()
-    table_lines = lines[start:end]
-    if len(table_lines) < 2:
-        return text, None
-    headers = [h.strip() for h in table_lines[0].strip().strip("|").split("|")]
-    rows = []
-    for r in table_lines[2:]:
-        parts = [c.strip() for c in r.strip().strip("|").split("|")]
-        if len(parts) == len(headers):
-            rows.append(parts)
-    if not rows:
-        return text, None
-    df = pd.DataFrame(rows, columns=headers)
-    # Attempt to numeric-cast value columns
+    table_lines = stripped[start:end]
+    table_markdown = "\n".join(lines[start:end])
+    # Drop body rows whose cell count differs from the header, then feed the rest to
+    # the C parser as pipe-separated text; it infers numeric dtypes
+    rows = ["|".join(c.strip() for c in r.strip("|").split("|")) for r in [table_lines[0]] + table_lines[2:]]
+    width = rows[0].count("|")
+    csv_text = "\n".join([rows[0]] + [r for r in rows[1:] if r.count("|") == width])
+    try:
+        df = pd.read_csv(
+            StringIO(csv_text),
+            sep="|",
+            engine="c",
+            skipinitialspace=True,
+            quoting=csv.QUOTE_NONE,
+            keep_default_na=False,
+            index_col=False,
+        )
+    except Exception:
+        return text, None, table_markdown
+    if df.empty:
+        return text, None, table_markdown
+    # Only columns made entirely of plain or thousands-grouped numbers (5 / 1,234 / -12,345.6)
+    # become numeric; ID lists like "3,4" or decimal-comma values stay as text
     for c in df.columns:
-        try:
-            df[c] = pd.to_numeric(df[c])
-        except Exception:
-            pass
-    return summary, df
+        if not pd.api.types.is_numeric_dtype(df[c]):
+            col = df[c].astype(str)
+            if col.str.fullmatch(_THOUSANDS_RE).all():
+                df[c] = pd.to_numeric(col.str.replace(",", "", regex=False))
+    return summary, df, table_markdown
 
 
 def render_chart(df: pd.DataFrame, chart_type: str):
+    import pandas as pd
+
     if df is None or df.empty:
         return False
     # Choose x as first column; y as numeric columns (excluding x)
@@ -251,8 +578,10 @@ def main():
                     st.write(summary)
                 df = None
                 if df_records and df_columns:
+                    import pandas as pd
+
                     try:
-                        df = pd.DataFrame(df_records, columns=df_columns)
+                        df = pd.DataFrame.from_records(df_records, columns=df_columns)
                     except Exception:
                         df = None
                 if chart_type and df is not None:
@@ -266,7 +595,7 @@ def main():
                             st.dataframe(df, use_container_width=True)
                 else:
                     # no chart; prefer markdown table if present
-                    if table_markdown and "|" in table_markdown and re.search(r"\n\|[-: ]+\|", table_markdown):
+                    if table_markdown:
                         st.markdown(table_markdown)
                     else:
                         st.write(msg)
@@ -283,30 +612,37 @@ def main():
             with st.spinner("Thinking…"):
                 greeting_terms = {"hi", "hello", "hey", "yo", "good morning", "good afternoon", "good evening"}
                 lower_input = user_input.strip().lower()
+                final_text = None
 
                 if lower_input in greeting_terms:
                     final_text = "Hello! Ask me about your tables, relationships, or data — for example: ‘Shipments by route as a line chart’."
                 else:
-                    agent = build_agent(llm, list_tables_tool, get_schema_tool)
-                    system_msg = (
-                        "You are a database analyst. Use the tools to list tables and fetch relevant schemas, then generate a correct Postgres query with quoted identifiers and execute it via db_exec_tool. "
-                        "Prefer user-friendly details over raw IDs: where possible, join to include human-friendly names (e.g., branch names, service type names). "
-                        "Choose exact table/column names from the tools—never invent names. If a tool call fails due to casing/missing relation, adjust quoting and retry once. "
-                        "Respond for non-technical users: first provide a concise plain-English summary (one or two sentences). Then include a small Markdown table (max 10 rows) with clear column headers suitable for charting (e.g., ‘Route’, ‘Shipments’). Do NOT show SQL or mention tools."
-                    )
-                    result = agent.invoke({
-                        "messages": [("system", system_msg), ("user", user_input)]
-                    })
-                    final_text = result["messages"][-1].content
+                    cache_key = normalize_question(user_input)
+                    final_text, cache_vector = cache_lookup(cache_key)
+
+                if final_text is None:
+                    agent = get_agent()
+                    system_msg = build_system_prompt(*get_db_metadata(db))
+                    placeholder = st.empty()
+                    buffer = ""
+                    for kind, value in iter_async(stream_answer(agent, system_msg, user_input)):
+                        if kind == "token":
+                            buffer += value
+                            placeholder.markdown(sanitize_text(buffer))
+                        elif kind == "reset":
+                            buffer = ""
+                            placeholder.empty()
+                        else:
+                            final_text = value or buffer
+                    placeholder.empty()
+                    cache_store(cache_key, cache_vector, final_text)
 
                 # Sanitize (keep whitespace for Markdown tables)
-                final_text = re.sub(r"```[\s\S]*?```", "", final_text).strip()
-                final_text = re.sub(r"db_exec_tool", "the database", final_text, flags=re.IGNORECASE)
-                final_text = re.sub(r"\bSQL\b", "the database", final_text, flags=re.IGNORECASE)
+                final_text = sanitize_text(final_text).strip()
 
                 # If a chart is requested, try to parse a Markdown table and render chart + summary
-                chart_type = wants_chart(user_input)
-                summary, df = extract_markdown_table(final_text)
+                chart_type = wants_chart(lower_input)
+                summary, df, table_markdown = extract_markdown_table(final_text)
 
                 render_payload = {"summary": summary or final_text}
                 rendered = False
@@ -332,7 +668,7 @@ def main():
                         rendered = True
                 else:
                     # Render default (table or text)
-                    if "|" in final_text and re.search(r"\n\|[-: ]+\|", final_text):
+                    if table_markdown is not None:
                         st.markdown(final_text)
                         render_payload.update({"table_markdown": final_text})
                         rendered = True
@@ -342,6 +678,7 @@ def main():
 
                 st.session_state.history.append(("assistant", final_text))
                 st.session_state.render_payloads.append(render_payload)
+                trim_history()
 
 
 if __name__ == "__main__":
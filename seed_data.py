@@ -1,13 +1,18 @@
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 from database import get_db, Base, engine, SessionLocal
 from models import User, Product, Order, OrderItem
 
 def seed_data(db: Session):
     # Ensure clean slate (idempotent seeding)
-    db.query(OrderItem).delete()
-    db.query(Order).delete()
-    db.query(Product).delete()
-    db.query(User).delete()
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("TRUNCATE order_items, orders, products, users RESTART IDENTITY CASCADE"))
+    else:
+        # SQLite and friends have no TRUNCATE
+        db.query(OrderItem).delete()
+        db.query(Order).delete()
+        db.query(Product).delete()
+        db.query(User).delete()
     db.commit()
 
     # Seed users
@@ -19,7 +24,7 @@ def seed_data(db: Session):
         User(name="carol lee", email="carol.lee@example.com", hobby="Cooking", job="Teacher", age=38),
     ]
     db.add_all(users)
-    db.commit()  # commit to persist and assign primary keys
+    db.flush()  # flush to assign primary keys
 
     # Seed products
     products = [
@@ -30,28 +35,34 @@ def seed_data(db: Session):
         Product(name="Water Bottle", category="Outdoors", price=14.99, stock=200),
     ]
     db.add_all(products)
-    db.commit()
+    db.flush()
 
     # Create a few orders with items (use relationships to avoid FK nulls)
     order1 = Order(user=users[0], status="completed")
     order2 = Order(user=users[1], status="shipped")
     order3 = Order(user=users[2], status="processing")
     db.add_all([order1, order2, order3])
-    db.commit()
+    db.flush()
+
+    # Bulk insert needs explicit FK ids (relationships aren't followed)
+    def item(order, product, quantity):
+        return OrderItem(order_id=order.order_id, product_id=product.product_id, quantity=quantity, unit_price=product.price)
 
     items = [
-        OrderItem(order=order1, product=products[0], quantity=2, unit_price=products[0].price),
-        OrderItem(order=order1, product=products[4], quantity=1, unit_price=products[4].price),
-        OrderItem(order=order2, product=products[1], quantity=1, unit_price=products[1].price),
-        OrderItem(order=order2, product=products[3], quantity=1, unit_price=products[3].price),
-        OrderItem(order=order3, product=products[2], quantity=1, unit_price=products[2].price),
+        item(order1, products[0], 2),
+        item(order1, products[4], 1),
+        item(order2, products[1], 1),
+        item(order2, products[3], 1),
+        item(order3, products[2], 1),
     ]
-    db.add_all(items)
+    db.bulk_save_objects(items)
 
-    # Compute totals
-    for order in [order1, order2, order3]:
-        total = sum(item.quantity * item.unit_price for item in order.items)
-        order.total_amount = total
+    # Compute totals server-side in one statement
+    db.execute(text(
+        "UPDATE orders SET total_amount = sub.total "
+        "FROM (SELECT order_id, SUM(quantity * unit_price) AS total FROM order_items GROUP BY order_id) sub "
+        "WHERE orders.order_id = sub.order_id"
+    ))
 
     db.commit()
 